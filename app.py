@@ -1,10 +1,11 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import os
 import re
+import time
+import hashlib
+from functools import lru_cache
 
 # --- CONFIGURATION ---
 SOCIETY_UPI_ID = "8143373163@kotak811"
@@ -15,85 +16,210 @@ SOCIETY_NAME_FULL = "RPE Owners/Residents Association"
 GOOGLE_SHEET_NAME = "Society_Payments_DB"
 MONTHLY_FEE = 300
 
+# Ledger "Plot No" column (B); looked up by header name if the sheet is rearranged
+LEDGER_PLOT_COL = 2
+LEDGER_COLS = ["Date", "Period", "Amt", "UTR", "Status"]
+
 # --- COMPACT STYLING ---
+CSS = """
+    <style>
+    .block-container {
+        padding-top: 2rem !important;
+        padding-bottom: 2rem !important;
+    }
+    .main-header {
+        background-color: var(--secondary-background-color);
+        padding: 12px 15px;
+        border-radius: 8px;
+        border-left: 5px solid #FF4B4B;
+        margin-bottom: 15px;
+        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+    }
+    .main-title {
+        color: var(--text-color);
+        font-size: 22px;
+        font-weight: bold;
+        margin: 0;
+        font-family: 'Segoe UI', sans-serif;
+    }
+    .sub-title {
+        color: var(--text-color);
+        opacity: 0.8;
+        font-size: 14px;
+        margin: 0;
+    }
+    div[data-testid="stForm"] {
+        background-color: var(--secondary-background-color);
+        padding: 15px;
+        border-radius: 8px;
+        border: 1px solid rgba(128, 128, 128, 0.2); 
+        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+    }
+    div[data-testid="stVerticalBlock"] > div {
+        gap: 0.5rem !important;
+    }
+    input[disabled] {
+        color: var(--text-color) !important;
+        -webkit-text-fill-color: var(--text-color) !important;
+        opacity: 1 !important;
+        font-weight: bold !important;
+    }
+    </style>
+"""
+
 def local_css():
-    st.markdown(
-        """
-        <style>
-        .block-container {
-            padding-top: 2rem !important;
-            padding-bottom: 2rem !important;
-        }
-        .main-header {
-            background-color: var(--secondary-background-color);
-            padding: 12px 15px;
-            border-radius: 8px;
-            border-left: 5px solid #FF4B4B;
-            margin-bottom: 15px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .main-title {
-            color: var(--text-color);
-            font-size: 22px;
-            font-weight: bold;
-            margin: 0;
-            font-family: 'Segoe UI', sans-serif;
-        }
-        .sub-title {
-            color: var(--text-color);
-            opacity: 0.8;
-            font-size: 14px;
-            margin: 0;
-        }
-        div[data-testid="stForm"] {
-            background-color: var(--secondary-background-color);
-            padding: 15px;
-            border-radius: 8px;
-            border: 1px solid rgba(128, 128, 128, 0.2); 
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        div[data-testid="stVerticalBlock"] > div {
-            gap: 0.5rem !important;
-        }
-        input[disabled] {
-            color: var(--text-color) !important;
-            -webkit-text-fill-color: var(--text-color) !important;
-            opacity: 1 !important;
-            font-weight: bold !important;
-        }
-        </style>
-        """,
-        unsafe_allow_html=True
-    )
+    # Re-emitted every run: Streamlit drops elements a rerun doesn't redraw
+    st.markdown(CSS, unsafe_allow_html=True)
 
 # --- GOOGLE SHEETS CONNECTION (CLOUD READY) ---
+# Cached so OAuth + open only happen once, not on every rerun
+@st.cache_resource(show_spinner=False)
 def get_google_sheet():
+    # Imported lazily: these are heavy and only needed once a sheet call runs
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
     creds_dict = st.secrets["gcp_service_account"]
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
     client = gspread.authorize(creds)
     return client.open(GOOGLE_SHEET_NAME).sheet1
 
+# Only auth failures justify dropping the shared cached handle (it is shared by
+# every session, so clearing on e.g. a 429 would re-auth everyone mid-quota)
+def is_auth_error(e):
+    from gspread.exceptions import APIError
+    # gspread.authorize() converts the oauth2client creds to google-auth, so
+    # token refresh failures surface as google-auth's RefreshError
+    from google.auth.exceptions import RefreshError
+
+    if isinstance(e, APIError):
+        return e.response.status_code in (401, 403)
+    return isinstance(e, RefreshError)
+
+# --- LEDGER WRITE (RETRY QUOTA ERRORS) ---
+# Only 429s are retried: they are rejected before any write, whereas a 500/503
+# may arrive after the append was applied and a retry would duplicate the batch
+def append_rows_with_retry(sheet, rows, attempts=5):
+    from gspread.exceptions import APIError
+
+    for attempt in range(attempts):
+        try:
+            sheet.append_rows(rows, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+            return
+        except APIError as e:
+            if e.response.status_code == 429 and attempt < attempts - 1:
+                time.sleep(2 ** attempt)
+                continue
+            raise
+
+# --- LEDGER READ (PLOT COLUMN + ONE PLOT'S ROWS, CACHED FOR 60s) ---
+@st.cache_data(ttl=60, show_spinner=False)
+def load_ledger(_sheet, plot_no):
+    # "_sheet": leading underscore tells st.cache_data not to hash the handle
+    # Read only the Plot No column to locate this plot's rows, then fetch the
+    # header + those rows in a single batch_get
+    plot_col = _sheet.col_values(LEDGER_PLOT_COL)
+    if not plot_col or str(plot_col[0]).strip() != "Plot No":
+        # Column moved (or empty sheet): find it by header name instead
+        header_row = [str(h).strip() for h in _sheet.row_values(1)]
+        if not header_row:
+            return None
+        if "Plot No" not in header_row:
+            raise KeyError("Plot No")
+        plot_col = _sheet.col_values(header_row.index("Plot No") + 1)
+
+    rows = [r for r, v in enumerate(plot_col, start=1) if r > 1 and str(v).strip() == str(plot_no)]
+    ranges = ["1:1"] + [f"{r}:{r}" for r in rows]
+    header, *matches = _sheet.batch_get(ranges)
+    header = header[0] if header else []
+
+    if not header:
+        return None
+
+    records = []
+    for m in matches:
+        values = (m[0] if m else [])[:len(header)]
+        records.append(values + [""] * (len(header) - len(values)))
+
+    # Normalize once per cache window so the expander only displays
+    ledger = pd.DataFrame(records, columns=header)
+    ledger.columns = ledger.columns.str.strip()
+    ledger = ledger.rename(columns={
+        "Date": "Date", "Period": "Period", "Amount": "Amt", 
+        "Transaction ID": "UTR", "Verified": "Status", 
+        "verified": "Status", "Payment verified": "Status",
+        "Payment Verified": "Status"
+    })
+    if "Status" not in ledger.columns: ledger["Status"] = "Pending"
+    return ledger[LEDGER_COLS]
+
+# --- RESIDENT LIST (STATIC PER DEPLOY, CACHED) ---
+class MissingLaneColumn(Exception):
+    pass
+
+@st.cache_data(show_spinner=False)
+def load_residents(path="data.csv"):
+    df = pd.read_csv(path)
+    df.columns = df.columns.str.strip()
+    df['Plot No.'] = df['Plot No.'].astype(str)
+
+    if 'Lane No.' not in df.columns:
+        raise MissingLaneColumn()
+    df = df.dropna(subset=['Lane No.'])
+    lanes = pd.to_numeric(df['Lane No.'], errors='coerce')
+    if lanes.notna().all() and (lanes % 1 == 0).all():
+        df['Lane No.'] = lanes.astype('Int64').astype(str)
+    else:
+        # Non-numeric lane labels: strip a trailing ".0" without the regex engine
+        lanes = df['Lane No.'].astype(str)
+        df['Lane No.'] = lanes.where(~lanes.str.endswith('.0'), lanes.str[:-2])
+
+    # Lookup tables so the rerun path is a dict fetch instead of a filter + sort
+    lane_to_plots = {
+        lane: sorted(grp['Plot No.'].unique(), key=natural_key)
+        for lane, grp in df.groupby('Lane No.')
+    }
+    unique_lanes = sorted(lane_to_plots, key=natural_key)
+
+    # Per-plot resident info with past dues parsed once, not on every rerun
+    if 'Past Dues' in df.columns:
+        dues = df['Past Dues']
+        if not pd.api.types.is_numeric_dtype(dues):
+            # Only strip "," / "₹" when the CSV actually has formatted amounts
+            dues = dues.astype(str).str.replace(',', '', regex=False).str.replace('₹', '', regex=False)
+        df['Past Dues'] = pd.to_numeric(dues, errors='coerce').fillna(0.0)
+    info_cols = [c for c in ('Name', 'Past Dues') if c in df.columns]
+    plot_info = df.drop_duplicates('Plot No.').set_index('Plot No.')[info_cols].to_dict(orient='index')
+    # Only the lookup tables: st.cache_data unpickles every returned object per hit
+    return lane_to_plots, plot_info, unique_lanes
+
 # --- HELPER: GENERATE MONTH LIST ---
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+QUARTERS = {"Q1": MONTHS[:3], "Q2": MONTHS[3:6], "Q3": MONTHS[6:9], "Q4": MONTHS[9:]}
+
 def get_target_months(p_type, year, qtr=None, month=None):
-    if p_type == "Year":
-        return ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-    elif p_type == "Quarter":
-        if qtr == "Q1": return ["Jan", "Feb", "Mar"]
-        if qtr == "Q2": return ["Apr", "May", "Jun"]
-        if qtr == "Q3": return ["Jul", "Aug", "Sep"]
-        if qtr == "Q4": return ["Oct", "Nov", "Dec"]
-    else:
-        return [month]
+    return {"Year": MONTHS, "Quarter": QUARTERS.get(qtr, ()), "Month": (month,)}[p_type]
 
 # --- HELPER: NATURAL SORTING ---
+_NAT_RE = re.compile(r'(\d+)')
+
+@lru_cache(maxsize=4096)
 def natural_key(text):
-    return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', str(text))]
+    # Split tokens alternate text/digits, so checking the first char is enough
+    return tuple(int(c) if c[:1].isdigit() else c.lower() for c in _NAT_RE.split(text))
 
 # --- PAGE SETUP ---
 st.set_page_config(page_title=SOCIETY_NAME_SHORT, page_icon="🏢", layout="wide")
 local_css()
 
+# Bind the worksheet once per rerun for the history path; keep the real error
+# (offline dev / missing secrets / quota) so it can be shown instead of hidden
+try:
+    sheet, sheet_error = get_google_sheet(), None
+except Exception as e:
+    sheet, sheet_error = None, e
+
 # Custom Header
 st.markdown(f"""
     <div class="main-header">
@@ -104,45 +230,71 @@ st.markdown(f"""
 
 # --- LOAD DATA ---
 try:
-    df = pd.read_csv("data.csv")
-    df.columns = df.columns.str.strip()
-    df['Plot No.'] = df['Plot No.'].astype(str)
-    
-    if 'Lane No.' in df.columns:
-        df = df.dropna(subset=['Lane No.'])
-        df['Lane No.'] = df['Lane No.'].astype(str).str.replace(r'\.0$', '', regex=True)
-    else:
-        st.error("⚠️ Column 'Lane No.' not found in data.csv.")
-        st.stop()
-        
+    lane_to_plots, plot_info, unique_lanes = load_residents()
 except FileNotFoundError:
     st.error("❌ Critical Error: 'data.csv' not found. Please upload it to GitHub.")
     st.stop()
+except MissingLaneColumn:
+    st.error("⚠️ Column 'Lane No.' not found in data.csv.")
+    st.stop()
 
 # --- INPUT SECTION ---
+# Plot + period live in one st.form so picking them costs a single rerun on "Continue"
 with st.container():
-    c_lane, c_plot, c_info = st.columns([1, 1, 2])
+    c_lane, c_form = st.columns([1, 4])
     
     with c_lane:
-        unique_lanes = sorted(df['Lane No.'].unique(), key=natural_key)
+        # Outside the form: the plot options depend on it
         selected_lane = st.selectbox("Lane", unique_lanes)
         
-    with c_plot:
-        filtered_plots = sorted(df[df['Lane No.'] == selected_lane]['Plot No.'].unique(), key=natural_key)
-        plot_no = st.selectbox("Plot", filtered_plots)
-        
-    resident_data = df[df['Plot No.'] == plot_no].iloc[0]
-    resident_name = resident_data['Name']
+    with c_form:
+        with st.form("filters", clear_on_submit=False, border=False):
+            c_plot, c_type, c_time = st.columns([1, 1.5, 2])
+            
+            with c_plot:
+                form_plot = st.selectbox("Plot", lane_to_plots[selected_lane])
+            
+            with c_type:
+                form_period = st.radio("Period", ["Year", "Quarter", "Month"], horizontal=True)
+
+            with c_time:
+                t1, t2, t3 = st.columns(3)
+                years = [str(y) for y in range(2022, 2029)]
+                form_year = t1.selectbox("Year", years)
+                # Both shown: widgets inside a form can't react to the Period choice until submit
+                form_qtr = t2.selectbox("Qtr", list(QUARTERS))
+                form_month = t3.selectbox("Month", MONTHS)
+
+            submitted = st.form_submit_button("Continue", use_container_width=True)
+
+    if submitted:
+        st.session_state["applied_filters"] = {
+            "plot_no": form_plot, "period_type": form_period, "year": form_year,
+            "qtr": form_qtr if form_period == "Quarter" else None,
+            "month": form_month if form_period == "Month" else None,
+        }
+
+if "applied_filters" not in st.session_state:
+    st.info("Select your Plot and Period, then press **Continue**.")
+    st.stop()
+
+applied = st.session_state["applied_filters"]
+plot_no = applied["plot_no"]
+period_type = applied["period_type"]
+selected_year = applied["year"]
+selected_qtr = applied["qtr"]; selected_month = applied["month"]
+
+with st.container():
+    info = plot_info[plot_no]
+    resident_name = info['Name']
+    
+    # --- PAYMENT CALCULATOR ---
+    c_info, c_amt = st.columns([3, 1.5])
     
     with c_info:
-        msg = f"👤 **{resident_name}**"
-        if 'Past Dues' in df.columns:
-            past_dues = resident_data['Past Dues']
-            try:
-                past_dues = float(str(past_dues).replace(',', '').replace('₹', ''))
-            except:
-                past_dues = 0
-            
+        msg = f"👤 **{resident_name}** (Plot {plot_no})"
+        if 'Past Dues' in info:
+            past_dues = info['Past Dues']
             if past_dues > 0:
                 st.error(f"{msg} | ⚠️ **Past Dues: ₹{int(past_dues)}**")
             else:
@@ -150,23 +302,6 @@ with st.container():
         else:
             st.info(msg)
 
-    # --- PAYMENT CALCULATOR ---
-    c_type, c_time, c_amt = st.columns([1.5, 2, 1.5])
-    
-    with c_type:
-        period_type = st.radio("Period", ["Year", "Quarter", "Month"], horizontal=True, label_visibility="collapsed")
-
-    with c_time:
-        t1, t2 = st.columns(2)
-        years = [str(y) for y in range(2022, 2029)]
-        selected_year = t1.selectbox("Year", years, label_visibility="collapsed")
-        
-        selected_qtr = None; selected_month = None
-        if period_type == "Quarter":
-            selected_qtr = t2.selectbox("Qtr", ["Q1", "Q2", "Q3", "Q4"], label_visibility="collapsed")
-        elif period_type == "Month":
-            selected_month = t2.selectbox("Month", ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], label_visibility="collapsed")
-
     if period_type == "Year": auto_amount = MONTHLY_FEE * 12
     elif period_type == "Quarter": auto_amount = MONTHLY_FEE * 3
     else: auto_amount = MONTHLY_FEE * 1
@@ -201,74 +336,92 @@ if auto_amount > 2000:
     st.code(SOCIETY_UPI_ID, language="text")
 
 # --- PROOF SUBMISSION FORM ---
-with st.form("verify_form", border=True):
-    st.write("**Submit Payment Proof**")
+# Fragment: submit/validation reruns only touch the form, not the selectors above
+@st.fragment
+def payment_form(plot_no, resident_name, auto_amount, period_type, selected_year, selected_qtr, selected_month):
+    with st.form("verify_form", border=True):
+        st.write("**Submit Payment Proof**")
     
-    f1, f2 = st.columns(2)
-    with f1:
-        amount_paid_user = st.number_input("Amount Paid (₹)", value=int(auto_amount), step=1)
-    with f2:
-        txn_id = st.text_input("UTR / Transaction ID")
+        f1, f2 = st.columns(2)
+        with f1:
+            amount_paid_user = st.number_input("Amount Paid (₹)", value=int(auto_amount), step=1)
+        with f2:
+            txn_id = st.text_input("UTR / Transaction ID")
         
-    uploaded_file = st.file_uploader("Screenshot (Optional)", type=['jpg', 'png', 'jpeg'], label_visibility="collapsed")
-    paid_confirm = st.checkbox(f"I transferred ₹{amount_paid_user}")
+        uploaded_file = st.file_uploader("Screenshot (Optional)", type=['jpg', 'png', 'jpeg'], label_visibility="collapsed")
+        paid_confirm = st.checkbox(f"I transferred ₹{amount_paid_user}")
     
-    if st.form_submit_button("✅ Verify & Record Payment", use_container_width=True):
-        if not paid_confirm:
-            st.error("Please confirm the checkbox.")
-        elif not txn_id and not uploaded_file:
-            st.error("Provide UTR or Screenshot.")
-        else:
-            with st.spinner("Recording..."):
-                try:
-                    target_months = get_target_months(period_type, selected_year, selected_qtr, selected_month)
-                    if len(target_months) > 0: split_amount = amount_paid_user / len(target_months)
-                    else: split_amount = amount_paid_user
-
-                    receipt_status = "Uploaded" if uploaded_file else "None"
-                    final_txn = txn_id if txn_id else "Screenshot"
-                    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if st.form_submit_button("✅ Verify & Record Payment", use_container_width=True):
+            target_months = get_target_months(period_type, selected_year, selected_qtr, selected_month)
+            if not paid_confirm:
+                st.error("Please confirm the checkbox.")
+            elif not txn_id and not uploaded_file:
+                st.error("Provide UTR or Screenshot.")
+            elif not target_months:
+                st.error("No months found for the selected period. Please re-select and press Continue.")
+            else:
+                # Idempotency key so a double-click or retry doesn't write the batch twice
+                period_key = f"{period_type}_{selected_qtr or selected_month or ''}_{selected_year}"
+                submit_key = hashlib.sha1(f"{plot_no}|{txn_id}|{amount_paid_user}|{period_key}".encode()).hexdigest()
+                submitted_keys = st.session_state.setdefault("submitted_keys", set())
+                if submit_key in submitted_keys:
+                    st.info("Already recorded. Your earlier submission was saved.")
+                else:
+                    with st.spinner("Recording..."):
+                        try:
+                            # Exact integer split: the last month absorbs the remainder
+                            # (e.g. 1000 over 12 months -> 11 x 83 + 87)
+                            n_months = len(target_months)
+                            split_amount, remainder = divmod(int(amount_paid_user), n_months)
+
+                            receipt_status = "Uploaded" if uploaded_file else "None"
+                            final_txn = txn_id if txn_id else "Screenshot"
+                            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     
-                    sheet = get_google_sheet()
-                    rows_to_add = []
+                            # Looked up per click (cached): fragment reruns reuse the args of the
+                            # last full run, so a passed-in handle could be None or stale here
+                            sheet = get_google_sheet()
+                            rows_to_add = []
                     
-                    for m in target_months:
-                        row = [
-                            current_time, plot_no, resident_name, f"{m} {selected_year}",
-                            split_amount, final_txn, receipt_status,
-                            f"Part of {period_type}", "Pending"
-                        ]
-                        rows_to_add.append(row)
+                            for i, m in enumerate(target_months):
+                                amount = split_amount + (remainder if i == n_months - 1 else 0)
+                                row = [
+                                    current_time, plot_no, resident_name, f"{m} {selected_year}",
+                                    amount, final_txn, receipt_status,
+                                    f"Part of {period_type}", "Pending"
+                                ]
+                                rows_to_add.append(row)
                     
-                    for row in rows_to_add: sheet.append_row(row)
-                    st.success("Saved! Your payment is recorded.")
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Error connecting to Google Sheets: {e}")
+                            append_rows_with_retry(sheet, rows_to_add)
+                            submitted_keys.add(submit_key)
+                            st.success("Saved! Your payment is recorded.")
+                            load_ledger.clear()
+                            st.rerun()
+                        except Exception as e:
+                            if is_auth_error(e):
+                                get_google_sheet.clear()  # reconnect on next attempt (expired creds)
+                            st.error(f"Error connecting to Google Sheets: {e}")
+
+payment_form(plot_no, resident_name, auto_amount, period_type, selected_year, selected_qtr, selected_month)
 
 # --- PAYMENT HISTORY (COMPACT) ---
-with st.expander(f"📜 History: {plot_no}", expanded=True):
-    try:
-        sheet = get_google_sheet()
-        data = sheet.get_all_records()
-        if data:
-            history_df = pd.DataFrame(data)
-            history_df.columns = history_df.columns.str.strip()
-            history_df['Plot No'] = history_df['Plot No'].astype(str)
-            my_history = history_df[history_df['Plot No'] == str(plot_no)]
-            
-            if not my_history.empty:
-                my_history = my_history.rename(columns={
-                    "Date": "Date", "Period": "Period", "Amount": "Amt", 
-                    "Transaction ID": "UTR", "Verified": "Status", 
-                    "verified": "Status", "Payment verified": "Status",
-                    "Payment Verified": "Status"
-                })
-                if "Status" not in my_history.columns: my_history["Status"] = "Pending"
-                st.dataframe(my_history[["Date", "Period", "Amt", "UTR", "Status"]], use_container_width=True, hide_index=True)
+# Runs on every full rerun; the cached load_ledger keeps that cheap
+def render_ledger(sheet, plot_no):
+    with st.expander(f"📜 History: {plot_no}", expanded=True):
+        if sheet is None:
+            st.warning(f"Error connecting to Google Sheets: {sheet_error}")
+            return
+        try:
+            ledger_df = load_ledger(sheet, plot_no)
+            if ledger_df is not None:
+                # load_ledger already returns only this plot's rows
+                if not ledger_df.empty:
+                    st.dataframe(ledger_df, use_container_width=True, hide_index=True)
+                else:
+                    st.info("No records found.")
             else:
-                st.info("No records found.")
-        else:
-            st.info("Ledger is empty.")
-    except:
-        st.warning("Loading history...")
\ No newline at end of file
+                st.info("Ledger is empty.")
+        except:
+            st.warning("Loading history...")
+
+render_ledger(sheet, plot_no)